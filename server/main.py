@@ -1,11 +1,64 @@
+import os
+# let the Rust tokenizer use its rayon thread pool for batched encodes;
+# must be set before transformers is imported
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
+# expandable segments let the caching allocator grow one VA reservation on
+# demand instead of fragmenting HBM across variable-length generations; costs
+# a little address space, avoids fragmentation OOMs on long-running servers.
+# Must be set before torch is imported.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512')
+
+# faster first-download of weights from the hub, when hf_transfer is installed
+try:
+    import hf_transfer  # noqa: F401
+    os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
+except ImportError:
+    pass
+
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, AsyncGenerator
+from collections import OrderedDict, defaultdict
+from uuid import uuid4
 import asyncio
+import copy
+import gc
+import hashlib
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+from transformers import (
+    AutoConfig, AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer,
+    StoppingCriteriaList, StopStringCriteria,
+)
+
+# vLLM is optional: when installed we serve /generate* through its paged KV
+# cache + continuous batching engine, otherwise we fall back to HF generate.
+try:
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+    _VLLM_AVAILABLE = True
+except ImportError:
+    _VLLM_AVAILABLE = False
+
+# log through a queue so request handlers never block on stdout I/O;
+# a background listener thread does the actual writes
+_log_queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+QueueListener(_log_queue, logging.StreamHandler()).start()
+logger = logging.getLogger(__name__)
+
+# prefer the fused scaled-dot-product attention kernels; math stays enabled
+# as the fallback for shapes/dtypes the fused kernels don't cover
+if torch.cuda.is_available():
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(True)
 
 app = FastAPI()
 
@@ -18,63 +71,492 @@ app.add_middleware(
     allow_headers=["*"],  # allows all headers
 )
 
-_models = {}
+# LRU of loaded models; bounded by a VRAM budget so the (N+1)-th distinct
+# model evicts the least-recently-used one instead of OOMing the GPU
+_models = OrderedDict()
+_model_sizes = {}
+_engines = {}
+# a single lock serializes every model load and eviction: per-model locks
+# would let two different models load at once and race the LRU bookkeeping,
+# and one GPU gains nothing from parallel multi-GB loads anyway. Loads run on
+# worker threads, hence a threading lock; cache hits never take it.
+_load_lock = threading.Lock()
+# in-flight generation counts per (model_id, quantization); eviction skips
+# models that are mid-generation so a concurrent stream isn't yanked off the
+# GPU underneath its decode loop
+_inflight = defaultdict(int)
+_inflight_lock = threading.Lock()
+# tokenizers and configs are cached separately so /tokenize and /config
+# never pay model-loading latency; only /generate* loads weights
+_tokenizers = {}
+_configs = {}
+
+# opt-in: compile the decoder forward into CUDA graphs (reduce-overhead).
+# Decode is launch-bound at batch 1, so graph replay cuts per-token overhead;
+# the trade-off is compile latency at load and a static-shape requirement.
+_COMPILE_MODEL = os.environ.get('COMPILE_MODEL', '0') == '1'
+_PAD_BUCKET = 64
+
+# micro-batching for the HF /generate path: concurrent requests landing within
+# the batching window share one model.generate call instead of serializing
+# prompt-by-prompt on the GPU
+_GEN_BATCH_SIZE = int(os.environ.get('GEN_BATCH_SIZE', '8'))
+_GEN_BATCH_WINDOW_S = 0.005
+_pending: asyncio.Queue = asyncio.Queue()
+
+# KV snapshots for shared prompt prefixes (system prompts, few-shot examples),
+# keyed by (model_id, quantization, sha256 of the prefix token ids). vLLM gets
+# the same effect for free via enable_prefix_caching.
+_prefix_cache = OrderedDict()
+_PREFIX_CACHE_SIZE = 8
 
 class GenerateRequest(BaseModel):
     model_id: str
     prompt: str
+    system_prompt: Optional[str] = None  # shared prefix, eligible for KV reuse
+    quantization: Optional[str] = None  # 'int8' or 'int4' weight-only quantization
+    stop: Optional[list[str]] = None  # stop strings that end generation early
+    include_ids: bool = False  # stream JSON {'text','ids'} frames instead of raw text
     max_new_tokens: int = 128
     temperature: float = 0.7
     top_p: float = 0.95
     repetition_penalty: float = 1.0
 
+class TokenizeRequest(BaseModel):
+    model_id: str
+    prompt: Optional[str] = None
+    prompts: Optional[list[str]] = None  # batch form; tokenized in one call
+
 class ConfigRequest(BaseModel):
     model_id: str
 
-def get_model(model_id: str):
-    if model_id in _models:
-        return _models[model_id]
-    
-    print(f"Loading model: {model_id}")
+def get_tokenizer(model_id: str):
+    if model_id in _tokenizers:
+        return _tokenizers[model_id]
+    # use_fast forces the Rust tokenizer, which is on every hot path here
+    tok = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+    _tokenizers[model_id] = tok
+    return tok
+
+def get_config(model_id: str):
+    if model_id in _configs:
+        return _configs[model_id]
+    config = AutoConfig.from_pretrained(model_id)
+    _configs[model_id] = config
+    return config
+
+def _vram_budget():
+    env = os.environ.get('MODEL_VRAM_BUDGET')
+    if env:
+        return int(env)
+    if torch.cuda.is_available():
+        return int(0.85 * torch.cuda.get_device_properties(0).total_memory)
+    return None  # no CUDA: nothing to budget
+
+# free-VRAM fraction a new load should see before from_pretrained runs; the
+# incoming checkpoint size isn't known until it's loaded, so pre-eviction
+# works off a headroom margin instead of the exact footprint
+_LOAD_HEADROOM = float(os.environ.get('MODEL_LOAD_HEADROOM', '0.3'))
+
+def _retain_model(key):
+    with _inflight_lock:
+        _inflight[key] += 1
+
+def _release_model(key):
+    """Callers of get_model hand the model back here once their generation
+    finishes, making it eligible for eviction again."""
+    with _inflight_lock:
+        _inflight[key] -= 1
+        if _inflight[key] <= 0:
+            del _inflight[key]
+
+def _evict_one():
+    """Evict the least-recently-used idle model. Returns False when every
+    resident model has generations in flight."""
+    for victim_key in list(_models):
+        # the in-flight check and the pop share a lock with _retain_model, so
+        # a request that just retained this model can't lose it mid-decode
+        with _inflight_lock:
+            if _inflight.get(victim_key, 0) > 0:
+                continue
+            victim = _models.pop(victim_key, None)
+        if victim is None:
+            continue
+        victim_tok, victim_model = victim
+        logger.info(f"Evicting model to free VRAM: {victim_key[0]}")
+        _model_sizes.pop(victim_key, None)
+        # drop KV prefix snapshots that pin GPU tensors for the evicted model
+        for stale in [k for k in _prefix_cache if k[:2] == victim_key]:
+            del _prefix_cache[stale]
+        # transformers blocks .to() on bitsandbytes models; dropping the last
+        # reference + empty_cache still frees their VRAM
+        if not getattr(victim_model, 'is_quantized', False):
+            victim_model.to('cpu')
+        del victim_tok, victim_model
+        gc.collect()
+        torch.cuda.empty_cache()
+        return True
+    return False
+
+def _evict_for_load():
+    """Before a load, drop LRU models until free VRAM clears the headroom
+    margin, so the incoming from_pretrained doesn't OOM against residents."""
+    if not torch.cuda.is_available():
+        return
+    free, total = torch.cuda.mem_get_info()
+    while _models and free < _LOAD_HEADROOM * total:
+        if not _evict_one():
+            break  # everything resident is mid-generation
+        free, total = torch.cuda.mem_get_info()
+
+def _evict_models(incoming_size: int):
+    """Drop least-recently-used models until incoming_size fits the budget."""
+    budget = _vram_budget()
+    if not budget:
+        return
+    while _models and sum(_model_sizes.values()) + incoming_size > budget:
+        if not _evict_one():
+            break
+
+def _cache_get(key):
+    """Look up a cached model and mark it in-flight; returns None on a miss.
+    Retaining before the lookup means _evict_one either sees the count and
+    skips us, or has already popped the key and we miss cleanly."""
+    _retain_model(key)
+    cached = _models.get(key)
+    if cached is None:
+        _release_model(key)
+        return None
+    try:
+        _models.move_to_end(key)
+    except KeyError:
+        _release_model(key)
+        return None
+    return cached
+
+def get_model(model_id: str, quantization: Optional[str] = None):
+    """Return (tok, model), loading on first use. The entry counts as
+    in-flight until the caller hands it back via _release_model(key)."""
+    key = (model_id, quantization)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    with _load_lock:
+        # another request may have finished the load while we waited
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        result = _load_model(key, model_id, quantization)
+        _retain_model(key)
+        return result
+
+def _load_model(key, model_id: str, quantization: Optional[str]):
+    logger.info(f"Loading model: {model_id} (quantization={quantization})")
     try:
-        tok = AutoTokenizer.from_pretrained(model_id)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_id, 
-            torch_dtype=torch.bfloat16, 
-            device_map='auto'
+        _evict_for_load()
+        vram_before = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+        tok = get_tokenizer(model_id)
+        # on a single GPU, an explicit device_map keeps the module tree free of
+        # accelerate dispatch hooks (a Python call per layer per token);
+        # 'auto' is only needed when sharding across devices
+        device_map = {'': 0} if torch.cuda.device_count() == 1 else 'auto'
+        # low_cpu_mem_usage mmaps safetensors shards straight onto the target
+        # device instead of materializing a full CPU copy first
+        load_kwargs = dict(
+            torch_dtype=torch.bfloat16,
+            device_map=device_map,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
         )
-        _models[model_id] = (tok, model)
-        print(f"Model loaded successfully: {model_id}")
-        return _models[model_id]
+        if quantization in ('int8', 'int4'):
+            # weight-only quantization halves/quarters the bytes streamed from
+            # HBM per decode step; needs bitsandbytes + CUDA
+            from transformers import BitsAndBytesConfig
+            load_kwargs['quantization_config'] = BitsAndBytesConfig(
+                load_in_8bit=quantization == 'int8',
+                load_in_4bit=quantization == 'int4',
+            )
+        elif quantization is not None:
+            raise ValueError(f"Unsupported quantization: {quantization}")
+        # fused attention: FA2 on Ampere+ when flash-attn is installed, SDPA
+        # otherwise; both avoid materializing the full NxN attention matrix
+        if torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8:
+            attn_impls = ['flash_attention_2', 'sdpa']
+        else:
+            attn_impls = ['sdpa']
+        for attn in attn_impls:
+            try:
+                model = AutoModelForCausalLM.from_pretrained(model_id, attn_implementation=attn, **load_kwargs)
+                break
+            except (ValueError, ImportError):
+                continue  # arch lacks support or flash-attn isn't installed
+        else:
+            # some older archs only ship the eager implementation
+            model = AutoModelForCausalLM.from_pretrained(model_id, **load_kwargs)
+        model.eval()
+        if _COMPILE_MODEL:
+            model.forward = torch.compile(model.forward, mode='reduce-overhead', fullgraph=False, dynamic=False)
+            if tok.pad_token_id is None:
+                tok.pad_token = tok.eos_token
+            tok.padding_side = 'left'
+            # pay the compile cost here rather than on the first real request
+            warmup = tok('warmup', return_tensors='pt', padding='max_length', max_length=_PAD_BUCKET).to(model.device)
+            with torch.inference_mode():
+                model.generate(**warmup, max_new_tokens=8, do_sample=False, cache_implementation='static')
+        size = (torch.cuda.memory_allocated() - vram_before) if torch.cuda.is_available() else 0
+        _evict_models(size)
+        _model_sizes[key] = size
+        _models[key] = (tok, model)
+        logger.info(f"Model loaded successfully: {model_id}")
+        return _models[key]
     except Exception as e:
-        print(f"Error loading model {model_id}: {e}")
+        logger.exception(f"Error loading model {model_id}: {e}")
         raise
 
-@app.post('/generate')
-def generate(req: GenerateRequest):
+# same duplicate-load guard as the HF cache: engine construction claims 0.9
+# of the GPU, so two concurrent first builds for one model are a certain OOM
+_engine_locks = defaultdict(threading.Lock)
+
+def get_engine(model_id: str):
+    """Lazily build one vLLM engine per model id (PagedAttention KV cache).
+    Blocking — call it from a worker thread, not the event loop."""
+    if model_id in _engines:
+        return _engines[model_id]
+
+    with _engine_locks[model_id]:
+        # another request may have finished the build while we waited
+        if model_id in _engines:
+            return _engines[model_id]
+        logger.info(f"Loading vLLM engine: {model_id}")
+        engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+            model=model_id,
+            dtype='bfloat16',
+            gpu_memory_utilization=0.9,
+            block_size=16,
+            enable_prefix_caching=True,
+        ))
+        _engines[model_id] = engine
+        return engine
+
+def _full_prompt(req: GenerateRequest) -> str:
+    return (req.system_prompt or '') + req.prompt
+
+def _sampling_params(req: GenerateRequest):
+    return SamplingParams(
+        temperature=req.temperature,
+        top_p=req.top_p,
+        max_tokens=req.max_new_tokens,
+        repetition_penalty=req.repetition_penalty,
+        stop=req.stop,
+    )
+
+def _stopping_kwargs(tok, req: GenerateRequest):
+    """Generate kwargs that let decoding end at EOS or a client stop string
+    instead of always running out max_new_tokens."""
+    kwargs = dict(
+        eos_token_id=tok.eos_token_id,
+        pad_token_id=tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id,
+    )
+    if req.stop:
+        kwargs['stopping_criteria'] = StoppingCriteriaList([StopStringCriteria(tok, req.stop)])
+    return kwargs
+
+def _to_device(inputs, device):
+    """Move tokenized inputs to the device; on CUDA, stage through pinned host
+    memory and copy asynchronously so the transfer overlaps in-flight work."""
+    if device.type != 'cuda':
+        return inputs.to(device)
+    return {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+
+def _prepare_hf_inputs(req: GenerateRequest, tok, model):
+    """Tokenize the full prompt; when a system_prompt is set, reuse a cached
+    KV snapshot for that prefix so repeated system prompts skip prefill."""
+    inputs = tok(_full_prompt(req), return_tensors='pt')
+    if _COMPILE_MODEL:
+        # bucket the prompt length so compiled graphs are reused across requests
+        n = inputs['input_ids'].shape[1]
+        bucketed = ((n + _PAD_BUCKET - 1) // _PAD_BUCKET) * _PAD_BUCKET
+        inputs = tok.pad(inputs, padding='max_length', max_length=bucketed, return_tensors='pt')
+    inputs = _to_device(inputs, model.device)
+    # static-cache generation can't resume from a DynamicCache snapshot
+    if not req.system_prompt or _COMPILE_MODEL:
+        return inputs, None
+
+    prefix_len = len(tok(req.system_prompt)['input_ids'])
+    if prefix_len == 0 or prefix_len >= inputs['input_ids'].shape[1]:
+        return inputs, None
+
+    prefix_ids = inputs['input_ids'][:, :prefix_len]
+    # KV values are model-instance-specific, so the bf16 and quantized
+    # variants of a model_id must not share snapshots
+    key = (req.model_id, req.quantization, hashlib.sha256(prefix_ids[0].cpu().numpy().tobytes()).hexdigest())
+    cached = _prefix_cache.get(key)
+    if cached is None:
+        with torch.inference_mode():
+            cached = model(prefix_ids, use_cache=True).past_key_values
+        _prefix_cache[key] = cached
+        if len(_prefix_cache) > _PREFIX_CACHE_SIZE:
+            _prefix_cache.popitem(last=False)
+    else:
+        _prefix_cache.move_to_end(key)
+    # generate() appends to the cache it is given, so hand out a copy
+    return inputs, copy.deepcopy(cached)
+
+# fraction of total VRAM below which cached allocator blocks are released
+_FREE_VRAM_FLOOR = 0.10
+
+def _maybe_empty_cache():
+    """Release cached allocator blocks, but only when free VRAM is nearly
+    exhausted — empty_cache is too expensive to run after every request."""
+    if not torch.cuda.is_available():
+        return
+    free, total = torch.cuda.mem_get_info()
+    if free < _FREE_VRAM_FLOOR * total:
+        torch.cuda.empty_cache()
+
+def _hf_generate(req: GenerateRequest):
+    key = (req.model_id, req.quantization)
+    tok, model = get_model(req.model_id, req.quantization)
     try:
-        tok, model = get_model(req.model_id)
-        inputs = tok(req.prompt, return_tensors='pt').to(model.device)
-        out = model.generate(
+        inputs, past = _prepare_hf_inputs(req, tok, model)
+        if past is not None:
+            inputs['past_key_values'] = past
+        gen_kwargs = dict(
             **inputs,
             max_new_tokens=req.max_new_tokens,
             do_sample=req.temperature > 0,
             temperature=req.temperature if req.temperature > 0 else None,
             top_p=req.top_p,
             repetition_penalty=req.repetition_penalty,
+            **_stopping_kwargs(tok, req),
         )
+        if _COMPILE_MODEL:
+            gen_kwargs['cache_implementation'] = 'static'
+        with torch.inference_mode():
+            out = model.generate(**gen_kwargs)
         text = tok.decode(out[0], skip_special_tokens=True)
-        return { 'text': text }
+    finally:
+        _release_model(key)
+    _maybe_empty_cache()
+    return { 'text': text }
+
+def _hf_generate_batch(reqs):
+    """Run one model.generate over several left-padded prompts at once."""
+    if len(reqs) == 1:
+        return [_hf_generate(reqs[0])]
+    r0 = reqs[0]
+    key = (r0.model_id, r0.quantization)
+    tok, model = get_model(r0.model_id, r0.quantization)
+    try:
+        if tok.pad_token_id is None:
+            tok.pad_token = tok.eos_token
+        tok.padding_side = 'left'
+        enc = _to_device(tok([_full_prompt(r) for r in reqs], return_tensors='pt', padding=True), model.device)
+        with torch.inference_mode():
+            out = model.generate(
+                **enc,
+                max_new_tokens=r0.max_new_tokens,
+                do_sample=r0.temperature > 0,
+                temperature=r0.temperature if r0.temperature > 0 else None,
+                top_p=r0.top_p,
+                repetition_penalty=r0.repetition_penalty,
+                **_stopping_kwargs(tok, r0),
+            )
+        texts = tok.batch_decode(out, skip_special_tokens=True)
+    finally:
+        _release_model(key)
+    _maybe_empty_cache()
+    return [{ 'text': t } for t in texts]
+
+def _batch_key(req: GenerateRequest):
+    # only requests with identical model + sampling settings can share a batch
+    return (req.model_id, req.quantization, req.max_new_tokens,
+            req.temperature, req.top_p, req.repetition_penalty,
+            tuple(req.stop or ()))
+
+async def _batch_worker():
+    while True:
+        batch = [await _pending.get()]
+        await asyncio.sleep(_GEN_BATCH_WINDOW_S)
+        while len(batch) < _GEN_BATCH_SIZE and not _pending.empty():
+            batch.append(_pending.get_nowait())
+        groups = {}
+        for req, fut in batch:
+            groups.setdefault(_batch_key(req), []).append((req, fut))
+        for group in groups.values():
+            try:
+                results = await asyncio.to_thread(_hf_generate_batch, [r for r, _ in group])
+                for (_, fut), result in zip(group, results):
+                    if not fut.done():
+                        fut.set_result(result)
+            except Exception as e:
+                for _, fut in group:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+@app.on_event('startup')
+async def start_batch_worker():
+    asyncio.create_task(_batch_worker())
+
+@app.post('/generate')
+async def generate(req: GenerateRequest):
+    try:
+        if _VLLM_AVAILABLE:
+            engine = await run_in_threadpool(get_engine, req.model_id)
+            final = None
+            async for out in engine.generate(_full_prompt(req), _sampling_params(req), uuid4().hex):
+                final = out
+            if final is None:
+                return JSONResponse(status_code=500, content={'error': 'engine produced no output'})
+            # echo the full prompt like the HF path's tok.decode(out[0]) does
+            return { 'text': _full_prompt(req) + final.outputs[0].text }
+        fut = asyncio.get_running_loop().create_future()
+        await _pending.put((req, fut))
+        return await fut
     except Exception as e:
-        print(f"Error in generate: {e}")
+        logger.exception(f"Error in generate: {e}")
         return JSONResponse(status_code=500, content={'error': str(e)})
 
-@app.post('/generate/stream')
-def generate_stream(req: GenerateRequest):
+# coalesce SSE frames: flush once the buffer is this large or this old,
+# instead of one socket write per token
+_SSE_FLUSH_CHARS = 32
+_SSE_FLUSH_S = 0.01
+
+class TokenIdStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that yields {'text', 'ids'} dicts, so one
+    generation run gives the frontend both the text and the token ids it
+    would otherwise fetch with a second /tokenize call."""
+
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self._pending_ids = []
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            value = value[0]
+        # the prompt hasn't been consumed yet on the first put
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self._pending_ids.extend(value.tolist())
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        ids, self._pending_ids = self._pending_ids, []
+        self.text_queue.put({ 'text': text, 'ids': ids }, timeout=self.timeout)
+        if stream_end:
+            self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+def _hf_prepare_stream(req: GenerateRequest):
+    """Blocking setup for a streamed generation: model, streamer, kwargs.
+    The model stays marked in-flight until _hf_event_stream releases it."""
+    key = (req.model_id, req.quantization)
+    tok, model = get_model(req.model_id, req.quantization)
     try:
-        tok, model = get_model(req.model_id)
-        inputs = tok(req.prompt, return_tensors='pt').to(model.device)
-        streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+        inputs, past = _prepare_hf_inputs(req, tok, model)
+        if past is not None:
+            inputs['past_key_values'] = past
+        streamer_cls = TokenIdStreamer if req.include_ids else TextIteratorStreamer
+        streamer = streamer_cls(tok, skip_prompt=True, skip_special_tokens=True)
 
         gen_kwargs = dict(
             **inputs,
@@ -84,83 +566,225 @@ def generate_stream(req: GenerateRequest):
             top_p=req.top_p,
             repetition_penalty=req.repetition_penalty,
             streamer=streamer,
+            **_stopping_kwargs(tok, req),
         )
+        if _COMPILE_MODEL:
+            gen_kwargs['cache_implementation'] = 'static'
+    except Exception:
+        _release_model(key)
+        raise
+    return key, model, streamer, gen_kwargs
 
-        def event_stream():
-            import threading
-            thread = threading.Thread(target=model.generate, kwargs=gen_kwargs)
-            thread.start()
-            try:
-                for piece in streamer:
-                    yield f"data: {piece}\n\n"
-            except Exception as e:
-                print(f"Streaming error: {e}")
-            finally:
-                thread.join()
+async def _hf_event_stream(key, model, streamer, gen_kwargs, stop=None, include_ids=False):
+    def _run_generate():
+        # generate runs on its own thread, so inference_mode must be entered there
+        with torch.inference_mode():
+            model.generate(**gen_kwargs)
+
+    def _frame(text, ids):
+        if include_ids:
+            return f"data: {json.dumps({ 'text': text, 'ids': ids })}\n\n"
+        return f"data: {text}\n\n"
 
-        return StreamingResponse(event_stream(), media_type='text/event-stream')
+    gen_task = asyncio.create_task(asyncio.to_thread(_run_generate))
+    loop = asyncio.get_running_loop()
+    pieces = iter(streamer)
+    emitted = ''
+    buffered = ''
+    buffered_ids = []
+    last_flush = loop.time()
+    try:
+        while True:
+            piece = await asyncio.to_thread(next, pieces, None)
+            if piece is None:
+                break
+            if include_ids:
+                buffered += piece['text']
+                buffered_ids.extend(piece['ids'])
+                emitted += piece['text']
+            else:
+                buffered += piece
+                emitted += piece
+            if stop and any(s in emitted for s in stop):
+                # don't wait for the generation thread to drain past the stop
+                break
+            now = loop.time()
+            if len(buffered) >= _SSE_FLUSH_CHARS or now - last_flush >= _SSE_FLUSH_S:
+                yield _frame(buffered, buffered_ids)
+                buffered = ''
+                buffered_ids = []
+                last_flush = now
+        if buffered or buffered_ids:
+            yield _frame(buffered, buffered_ids)
     except Exception as e:
-        print(f"Error in generate_stream: {e}")
-        return JSONResponse(status_code=500, content={'error': str(e)})
+        logger.exception(f"Streaming error: {e}")
+    finally:
+        await gen_task
+        _release_model(key)
+        _maybe_empty_cache()
 
-@app.post('/tokenize')
-def tokenize_text(req: GenerateRequest):
-    """Tokenize text without running generation"""
+@app.post('/generate/stream')
+async def generate_stream(req: GenerateRequest):
     try:
-        tok, _ = get_model(req.model_id)
-        encoded = tok(req.prompt, return_tensors='pt')
-        token_ids = encoded['input_ids'][0].tolist()
-        tokens = [tok.decode([tid]) for tid in token_ids]
-        return {
+        if _VLLM_AVAILABLE:
+            engine = await run_in_threadpool(get_engine, req.model_id)
+            request_id = uuid4().hex
+
+            async def event_stream():
+                sent = 0
+                sent_ids = 0
+                try:
+                    async for out in engine.generate(_full_prompt(req), _sampling_params(req), request_id):
+                        delta = out.outputs[0].text[sent:]
+                        sent += len(delta)
+                        if not delta:
+                            continue
+                        if req.include_ids:
+                            delta_ids = list(out.outputs[0].token_ids[sent_ids:])
+                            sent_ids += len(delta_ids)
+                            yield f"data: {json.dumps({ 'text': delta, 'ids': delta_ids })}\n\n"
+                        else:
+                            yield f"data: {delta}\n\n"
+                except asyncio.CancelledError:
+                    # client disconnected; free the engine's KV blocks
+                    await engine.abort(request_id)
+                    raise
+
+            return StreamingResponse(event_stream(), media_type='text/event-stream')
+        key, model, streamer, gen_kwargs = await run_in_threadpool(_hf_prepare_stream, req)
+        return StreamingResponse(
+            _hf_event_stream(key, model, streamer, gen_kwargs, stop=req.stop, include_ids=req.include_ids),
+            media_type='text/event-stream')
+    except Exception as e:
+        logger.exception(f"Error in generate_stream: {e}")
+        return JSONResponse(status_code=500, content={'error': str(e)})
+
+# per-model memo of single-token surface forms; token ids repeat heavily
+# across prompts, and the table saturates at vocab size (~50k for gpt2)
+_token_strs = {}
+
+def _token_strings(tok, model_id, token_ids):
+    cache = _token_strs.setdefault(model_id, {})
+    misses = [tid for tid in dict.fromkeys(token_ids) if tid not in cache]
+    if misses:
+        # one batched call for the ids we haven't seen before
+        cache.update(zip(misses, tok.batch_decode([[tid] for tid in misses])))
+    return [cache[tid] for tid in token_ids]
+
+def _tokenize_batch(tok, model_id, prompts):
+    # one call into the Rust tokenizer for the whole batch; plain python
+    # lists throughout, no point building a torch tensor here
+    encoded = tok(prompts)['input_ids']
+    return [
+        {
             'token_ids': token_ids,
-            'tokens': tokens,
+            'tokens': _token_strings(tok, model_id, token_ids),
             'count': len(token_ids)
         }
+        for token_ids in encoded
+    ]
+
+@app.post('/tokenize')
+async def tokenize_text(req: TokenizeRequest):
+    """Tokenize text without running generation"""
+    try:
+        tok = await run_in_threadpool(get_tokenizer, req.model_id)
+        prompts = req.prompts if req.prompts is not None else [req.prompt or '']
+        results = await run_in_threadpool(_tokenize_batch, tok, req.model_id, prompts)
+        if req.prompts is None:
+            return results[0]
+        return { 'results': results }
     except Exception as e:
-        print(f"Error in tokenize: {e}")
+        logger.exception(f"Error in tokenize: {e}")
         return JSONResponse(status_code=500, content={'error': str(e)})
 
+# config fields the visualization cares about, covering both GPT-style
+# (n_embd, n_head, n_layer) and LLaMA-style (hidden_size, num_attention_heads,
+# num_hidden_layers) naming
+_CONFIG_ATTRS = frozenset({
+    'n_embd', 'hidden_size', 'n_head', 'num_attention_heads',
+    'n_layer', 'num_hidden_layers', 'vocab_size',
+    'block_size', 'max_position_embeddings'
+})
+_config_cache = {}
+
 @app.post('/config')
 def get_model_config(req: ConfigRequest):
     """Get model configuration for visualization"""
     try:
-        print(f"Config request received for model: {req.model_id}")
-        tok, model = get_model(req.model_id)
-        config = model.config
-        
-        # Extract common config fields for visualization
-        # Support both GPT-style (n_embd, n_head, n_layer) and LLaMA-style (hidden_size, num_attention_heads, num_hidden_layers)
-        config_dict = {}
-        
-        # Try to get each attribute, only include if it exists
-        attrs = [
-            'n_embd', 'hidden_size', 'n_head', 'num_attention_heads',
-            'n_layer', 'num_hidden_layers', 'vocab_size',
-            'block_size', 'max_position_embeddings'
-        ]
-        
-        for attr in attrs:
-            if hasattr(config, attr):
-                value = getattr(config, attr)
-                if value is not None:
-                    config_dict[attr] = value
-        
-        # Also include the full config dict as fallback for any missing fields
-        if hasattr(config, 'to_dict'):
-            raw_config = config.to_dict()
-            # Merge any missing fields from raw config
-            for key in attrs:
-                if key not in config_dict and key in raw_config:
-                    config_dict[key] = raw_config[key]
-        
-        print(f"Config extracted: {list(config_dict.keys())}")
+        # the config never changes for a given model, so repeat calls are a dict hit
+        if req.model_id in _config_cache:
+            return _config_cache[req.model_id]
+
+        logger.info(f"Config request received for model: {req.model_id}")
+        config = get_config(req.model_id)
+        raw = config.to_dict() if hasattr(config, 'to_dict') else vars(config)
+        config_dict = {k: v for k, v in raw.items() if k in _CONFIG_ATTRS and v is not None}
+        # to_dict() only holds stored key names; aliases like GPT-2's
+        # max_position_embeddings -> n_positions resolve through
+        # attribute_map, so fill the remaining fields via getattr
+        for attr in _CONFIG_ATTRS - config_dict.keys():
+            value = getattr(config, attr, None)
+            if value is not None:
+                config_dict[attr] = value
+        _config_cache[req.model_id] = config_dict
+
+        logger.info(f"Config extracted: {list(config_dict.keys())}")
         return config_dict
     except Exception as e:
-        print(f"Error in get_model_config: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error in get_model_config: {e}")
         return JSONResponse(status_code=500, content={'error': str(e)})
 
+_WARMUP_LENS = [32, 128, 512, 2048]
+
+@app.on_event('startup')
+def warmup_models():
+    """Pre-load WARMUP_MODELS (comma-separated) and run a tiny generate at
+    each bucketed prompt length, so the first real request doesn't pay cuBLAS
+    heuristic selection, allocator warm-up or torch.compile specialization."""
+    warmup_ids = [m.strip() for m in os.environ.get('WARMUP_MODELS', '').split(',') if m.strip()]
+    if _VLLM_AVAILABLE:
+        # /generate* is served by vLLM here; warming HF copies would only eat
+        # the VRAM the engine claims (gpu_memory_utilization=0.9). Engine
+        # construction does its own profiling/warm-up run.
+        for model_id in warmup_ids:
+            try:
+                get_engine(model_id)
+            except Exception as e:
+                logger.warning(f"Failed to warm up engine {model_id}: {e}")
+        return
+    for model_id in warmup_ids:
+        try:
+            tok, model = get_model(model_id)
+            try:
+                for length in _WARMUP_LENS:
+                    ids = torch.zeros(1, length, dtype=torch.long, device=model.device)
+                    warmup_kwargs = dict(
+                        max_new_tokens=4,
+                        do_sample=False,
+                        pad_token_id=tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id,
+                    )
+                    if _COMPILE_MODEL:
+                        warmup_kwargs['cache_implementation'] = 'static'
+                    with torch.inference_mode():
+                        model.generate(ids, **warmup_kwargs)
+            finally:
+                _release_model((model_id, None))
+            logger.info(f"Warmed up model: {model_id}")
+        except Exception as e:
+            logger.warning(f"Failed to warm up {model_id}: {e}")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+@app.on_event('startup')
+def prewarm_tokenizers():
+    """Pre-load tokenizers for a comma-separated PREWARM_TOKENIZERS list."""
+    for model_id in filter(None, os.environ.get('PREWARM_TOKENIZERS', '').split(',')):
+        try:
+            get_tokenizer(model_id.strip())
+        except Exception as e:
+            logger.warning(f"Failed to pre-warm tokenizer {model_id}: {e}")
+
 @app.get('/health')
 def health():
     return { 'ok': True }